@@ -1,9 +1,15 @@
 #!/usr/bin/env python
+import ast
+import atexit
+import re
 import socket
 import time
 import datetime
-from threading import Lock
+import logging
+from collections import deque
+from threading import Event, Lock, RLock
 
+import numpy as np
 from sardana import State, DataAccess
 from sardana.pool import AcqSynch
 from sardana.pool.controller import OneDController, Type, Access, \
@@ -14,10 +20,39 @@ import six
 
 __all__ = ['Albaem2OneDCtrl']
 
+# Clock for elapsed times, not affected by system clock changes
+monotonic = getattr(time, 'monotonic', time.time)
+
 MINIMUM_INTEGRATION_TIME_MS = 0.1
 # for details of the maximum time calculation see em2.py:
 #   Em2._correct_for_long_acquisition_scaling_bug
 MAXIMUM_INTEGRATION_TIME_WITHOUT_OVERFLOW_MS = 2621.0
+SOFTWARE_SYNCHRONIZATIONS = frozenset([AcqSynch.SoftwareTrigger,
+                                       AcqSynch.SoftwareGate])
+HARDWARE_SYNCHRONIZATIONS = frozenset([AcqSynch.HardwareTrigger,
+                                       AcqSynch.HardwareGate])
+STATES = {
+    'STATE_ACQUIRING': State.Moving,
+    'STATE_RUNNING': State.Moving,
+    'STATE_ON': State.On,
+    'STATE_FAULT': State.Fault,
+}
+CACHED_QUERIES = frozenset(['ACQU:STAT?', 'ACQU:NDAT?', 'ACQU:MODE?'])
+CMD_CACHE_TTL = 0.002
+START_TIMEOUT = 3
+# StartAll waits for the acquisition with an exponential backoff
+START_POLL_MIN_PERIOD = 0.0002
+START_POLL_MAX_PERIOD = 0.01
+RECV_SIZE = 65536
+SOCKET_TIMEOUT = 5
+COMMAND_RETRIES = 2
+SOCKET_RCVBUF_SIZE = 1 << 20
+# TCP keepalive: idle time and interval between probes (s), and number of
+# unanswered probes before the connection is dropped
+KEEPALIVE_OPTIONS = (('TCP_KEEPIDLE', 5), ('TCP_KEEPINTVL', 1),
+                     ('TCP_KEEPCNT', 3))
+# ACQU:MEAS? answers e.g. [['CHAN01', [1.0, 2.0]], ['CHAN02', [3.0, 4.0]]]
+MEAS_CHANNEL_RE = re.compile(r"(CHAN\d+)['\"]?\s*,\s*\[([^\[\]]*)\]")
 
 
 def debug_it(func):
@@ -32,6 +67,25 @@ def debug_it(func):
     return wrapper
 
 
+def parse_measurement(raw_data):
+    """Parse the ACQU:MEAS? answer into a list of (channel, values) pairs,
+    without going through the Python parser."""
+    channels = MEAS_CHANNEL_RE.findall(raw_data)
+    if not channels:
+        # Unexpected format, let Python parse the literal
+        return [(chn_name, np.asarray(values, dtype=np.float64))
+                for chn_name, values in ast.literal_eval(raw_data)]
+    data = []
+    for chn_name, values in channels:
+        if values.strip():
+            # Unlike np.fromstring, this raises on a malformed value
+            values = np.array(values.split(','), dtype=np.float64)
+        else:
+            values = np.empty(0, dtype=np.float64)
+        data.append((chn_name, values))
+    return data
+
+
 def handle_error(func=None, msg="Error with Albaem2OneDCtrl"):
     if func is None:
         return partial(handle_error, msg=msg)
@@ -45,9 +99,361 @@ def handle_error(func=None, msg="Error with Albaem2OneDCtrl"):
         return wrapper
 
 
+class Reply(object):
+    """Answer slot of a command waiting in the connection pipeline."""
+
+    def __init__(self):
+        self.answer = None
+        self.error = None
+        self.done = False
+        self._event = Event()
+
+    def set(self, answer=None, error=None):
+        self.answer = answer
+        self.error = error
+        self.done = True
+        self._event.set()
+
+    def wake(self):
+        # Not answered, but the socket is free to be read
+        self._event.set()
+
+    def wait(self, timeout):
+        self._event.wait(timeout)
+        self._event.clear()
+        return self.done
+
+
+class AlbaemConnection(object):
+    """
+    SCPI connection to the AlbaEm2.
+
+    The calling threads write their commands to the socket and the answers
+    are handed back in the order the commands were sent, so several threads
+    can have commands in flight at the same time. There is no reader
+    thread: one of the waiting threads reads the socket and passes the
+    answers of the others to them.
+    """
+
+    def __init__(self, host, port):
+        self.ip_config = (host, port)
+        # Recent answers of CACHED_QUERIES: cmd -> (timestamp, answer). The
+        # generation changes whenever the answers may change.
+        self._cache = {}
+        self._cache_generation = 0
+        self.log = logging.getLogger(__name__ + '.AlbaemConnection')
+        self._send_lock = Lock()
+        self._read_lock = Lock()
+        self._sock = None
+        self._pending = None
+        self._buf = None
+        self._chunk = bytearray(RECV_SIZE)
+        self._last_activity = 0
+
+    def connect(self):
+        with self._send_lock:
+            if self._sock is None:
+                self._connect()
+
+    def reconnect(self, sock=None):
+        with self._send_lock:
+            # Another thread may have already replaced the socket
+            if sock is None or self._sock is sock:
+                self._connect()
+
+    def close(self):
+        with self._send_lock:
+            if self._sock is not None:
+                self._close()
+
+    def _connect(self):
+        if self._sock is not None:
+            self._close()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Big kernel buffer, so long ACQU:MEAS? answers need fewer recv calls
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                        SOCKET_RCVBUF_SIZE)
+        # Commands are short request/answer exchanges, do not let Nagle's
+        # algorithm hold them back
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # Let TCP detect a dead electrometer in a few seconds instead of
+        # the read timeouts. The default keepalive timers take hours, they
+        # are shortened where the platform allows it
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        for option, value in KEEPALIVE_OPTIONS:
+            if hasattr(socket, option):
+                sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option),
+                                value)
+        sock.settimeout(SOCKET_TIMEOUT)
+        sock.connect(self.ip_config)
+        self._sock = sock
+        self._pending = deque()
+        # Bytes received after the last complete answer
+        self._buf = bytearray()
+        self._invalidate_cache()
+
+    def _close(self):
+        sock, pending = self._sock, self._pending
+        self._sock = None
+        try:
+            # Wake up the thread reading it
+            sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        sock.close()
+        self._fail(pending, 'Connection closed')
+
+    @staticmethod
+    def _fail(pending, error):
+        while pending:
+            try:
+                reply = pending.popleft()
+            except IndexError:
+                break
+            reply.set(error=error)
+
+    def _send(self, cmds):
+        replies = deque(Reply() for cmd in cmds)
+        # One line per command, all of them written at once
+        data = ''.join(cmd + ';\n' for cmd in cmds).encode()
+        with self._send_lock:
+            if self._sock is None:
+                self._connect()
+            sock = self._sock
+            if not all('?' in cmd for cmd in cmds):
+                # Any setting or start/stop may change the answers
+                self._invalidate_cache()
+            # Queue the replies before sending, the answers may be read by
+            # another thread before sendall returns
+            self._pending.extend(replies)
+            self._last_activity = monotonic()
+            try:
+                sock.sendall(data)
+            except socket.error as e:
+                # Protection in case of reconnect the device in the
+                # network. The pending commands fail and are sent again.
+                self.log.debug('Error sending %s: %s, reconnecting', cmds, e)
+                self._connect()
+        return replies, sock
+
+    def _wait(self, reply, timeout):
+        # The timeout counts from the last data exchanged, so long answers
+        # which keep arriving are not interrupted
+        while not reply.done:
+            if self._read_lock.acquire(False):
+                # Nobody else is reading, read the answers in this thread.
+                # Unlike Event.wait, a blocking recv does not poll on
+                # Python 2.
+                try:
+                    if not self._read(reply, timeout):
+                        return False
+                finally:
+                    self._read_lock.release()
+                    self._wake_readers()
+            elif not reply.wait(timeout):
+                if monotonic() - self._last_activity > timeout:
+                    return False
+        return True
+
+    def _wake_readers(self):
+        # One of the threads still waiting has to take over the reading
+        pending = self._pending
+        if pending:
+            for reply in list(pending):
+                reply.wake()
+
+    def command(self, cmd, rw=True, timeout=SOCKET_TIMEOUT,
+                retries=COMMAND_RETRIES, use_cache=True):
+        """Send the command and return the raw answer, terminator
+        included. Without rw, return once sent and drop the answer.
+
+        The idempotent CACHED_QUERIES repeated within CMD_CACHE_TTL reuse
+        the answer, unless use_cache is False.
+        """
+        is_cached = cmd in CACHED_QUERIES
+        if is_cached:
+            if use_cache:
+                timestamp, answer = self._cache.get(cmd, (0, None))
+                if monotonic() - timestamp < CMD_CACHE_TTL:
+                    return answer
+            # Taken before sending, an answer which crosses a setting is
+            # not kept
+            generation = self._cache_generation
+        answers = self.commands([cmd], rw, timeout, retries)
+        if answers is None:
+            return None
+        if is_cached:
+            with self._send_lock:
+                if generation == self._cache_generation:
+                    self._cache[cmd] = (monotonic(), answers[0])
+        return answers[0]
+
+    def _invalidate_cache(self):
+        self._cache.clear()
+        self._cache_generation += 1
+
+    def commands(self, cmds, rw=True, timeout=SOCKET_TIMEOUT,
+                 retries=COMMAND_RETRIES):
+        """Send the commands, one per line, and return the list of raw
+        answers. All the commands are sent before waiting for the first
+        answer, in a single round trip."""
+        # The device answers every command, the replies are always queued
+        # so the answers are not taken by the next commands
+        replies, sock = self._send(cmds)
+        if not rw:
+            return None
+        answers = []
+        failures = 0
+        # SOME TIMEOUTS OCCUR WHEN USING THE WEBPAGE
+        while replies:
+            cmd = cmds[len(answers)]
+            if self._wait(replies[0], timeout):
+                reply = replies.popleft()
+                if reply.error is None:
+                    answers.append(reply.answer)
+                    continue
+                self.log.debug('%s while reading %s command, sending again',
+                               reply.error, cmd)
+                send = True
+            elif self._is_connected(sock):
+                # A slow answer does not mean a broken connection, keep
+                # waiting for it
+                self.log.debug(
+                    'Socket timeout! Reading... from  %s command', cmd)
+                send = False
+            else:
+                self.log.debug(
+                    'Socket error! Reconnecting and commanding again %s', cmd)
+                self.reconnect(sock)
+                send = True
+            failures += 1
+            if failures >= retries:
+                if not send:
+                    # The answer never came, renew the connection so that
+                    # it can not be taken as the answer of a later command
+                    self.reconnect(sock)
+                raise RuntimeError("Unable to communicate with AlbaEm2, "
+                                   "try to restart the Device")
+            if send:
+                # The remaining commands, the answers to the others were
+                # already received
+                replies, sock = self._send(cmds[len(answers):])
+        return answers
+
+    @staticmethod
+    def _is_connected(sock):
+        try:
+            return not sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        except socket.error:
+            # Already closed
+            return False
+
+    def ensure_alive(self):
+        """Replace the connection if its socket reports an error."""
+        # No round trip, the commands of the other controllers may be
+        # waiting for long answers and must not be interrupted
+        sock = self._sock
+        if sock is not None and not self._is_connected(sock):
+            self.log.debug('Socket error, the connection is renewed')
+            self.reconnect(sock)
+
+    def _read(self, reply, timeout):
+        """Read the answers until the one of the reply, return False if no
+        data came in timeout seconds."""
+        with self._send_lock:
+            if reply.done:
+                return True
+            # Not answered yet, so the socket was not replaced
+            sock, pending, buf = self._sock, self._pending, self._buf
+        # WARNING...
+        # socket.recv(size) IS NEVER ENOUGH TO RECEIVE DATA !!!
+        # you should know by the protocol either:
+        # the length of data to be received
+        # or
+        # wait until a special end-of-transfer control
+        # In this case: while not '\r' in data:
+        #                 receive more data...
+        ################################################
+        # AS IT IS SAID IN https://docs.python.org/3/howto/sockets.html
+        # SECTION "3 Using a Socket"
+        #
+        # A protocol like HTTP uses a socket for only one
+        # transfer. The client sends a request, the reads a
+        # reply. That's it. The socket is discarded. This
+        # means that a client can detect the end of the reply
+        # by receiving 0 bytes.
+        #
+        # But if you plan to reuse your socket for further
+        # transfers, you need to realize that there is no
+        # "EOT" (End of Transfer) on a socket. I repeat: if a
+        # socket send or recv returns after handling 0 bytes,
+        # the connection has been broken. If the connection
+        # has not been broken, you may wait on a recv forever,
+        # because the socket will not tell you that there's
+        # nothing more to read (for now). Now if you think
+        # about that a bit, you'll come to realize a
+        # fundamental truth of sockets: messages must either
+        # be fixed length (yuck), or be delimited (shrug), or
+        # indicate how long they are (much better), or end by
+        # shutting down the connection. The choice is entirely
+        # yours, (but some ways are righter than others).
+        ################################################
+        # Accumulate the raw bytes and decode each answer only once.
+        # The socket reads into a preallocated chunk, so no new bytes
+        # object is created per recv.
+        chunk = self._chunk
+        chunk_view = memoryview(chunk)
+        try:
+            sock.settimeout(timeout)
+        except socket.error:
+            # Closed by another thread
+            return reply.done
+        while not reply.done:
+            try:
+                nbytes = sock.recv_into(chunk)
+            except socket.timeout:
+                return False
+            except socket.error as e:
+                error = e
+                break
+            if not nbytes:
+                error = 'Connection closed'
+                break
+            self._last_activity = monotonic()
+            # The bytes already in the buffer hold no terminator, only the
+            # new chunk needs to be scanned
+            start = len(buf)
+            buf += chunk_view[:nbytes]
+            end = buf.find(b'\n', start)
+            while end >= 0:
+                answer = buf[:end + 1].decode()
+                del buf[:end + 1]
+                try:
+                    pending.popleft().set(answer)
+                except IndexError:
+                    self.log.warning('Unexpected answer %r', answer)
+                end = buf.find(b'\n')
+        else:
+            return True
+
+        with self._send_lock:
+            if self._sock is sock:
+                # Connect again on the next command
+                self._sock = None
+                sock.close()
+        self._fail(pending, error)
+        return True
+
+
 class Albaem2OneDCtrl(OneDController):
     MaxDevice = 5
 
+    # Pool of connections, one per (host, port)
+    _connections = {}
+    _connection_users = {}
+    # Reentrant, __del__ may run from a garbage collection inside it
+    _connections_lock = RLock()
+
     ctrl_properties = {
         'AlbaEmHost': {
             Description: 'AlbaEm Host name',
@@ -114,7 +520,9 @@ class Albaem2OneDCtrl(OneDController):
             Type: str,
             Description: 'The formula to get the real value.\n '
                             'e.g. "(value/10)*1e-06"',
-            Access: DataAccess.ReadWrite
+            Access: DataAccess.ReadWrite,
+            FGet: "get_Formula",
+            FSet: "set_Formula",
         },
     }
 
@@ -123,28 +531,49 @@ class Albaem2OneDCtrl(OneDController):
         """Class initialization."""
         OneDController.__init__(self, inst, props, *args, **kwargs)
         self.ip_config = (self.AlbaEmHost, self.Port)
-        self.albaem_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.albaem_socket.settimeout(1)
-        self.albaem_socket.connect(self.ip_config)
+        # The connection and its answers cache are shared by all the
+        # controllers of the same electrometer
+        self._connection = None
+        self._acquire_connection()
         self.itime = 0.0
         self.master = None
         self._latency_time = 0.001  # In fact, it is just 320us
         self._repetitions = 0
         self.formulas = {1: 'value', 2: 'value', 3: 'value', 4:'value'}
+        self._formula_funcs = {}
+        for axis, formula in self.formulas.items():
+            self._formula_funcs[axis] = self._compile_formula(formula)
         self._points_per_step = 1
         self._is_aborted = False
-        self.lock = Lock()
+        self._sw_synchronization = True
+        self._sw_values = ([],) * self.MaxDevice
+        self._cmds = {}
 
     @debug_it
     def AddDevice(self, axis):
         """Add device to controller."""
-        pass
+        if axis == 1:
+            return
+        # Channel commands are formatted once per axis
+        chn = 'CHAN{0:02d}:'.format(axis - 1)
+        self._cmds[axis] = {
+            'range_q': chn + 'CABO:RANGE?',
+            'range_s': chn + 'CABO:RANGE ',
+            'inv_q': chn + 'CABO:INVE?',
+            'inv_s': chn + 'CABO:INVE ',
+            'cur_q': chn + 'INSCurrent?',
+        }
 
     @debug_it
     def DeleteDevice(self, axis):
         """Delete device from the controller."""
-        # self.albaem_socket.close()
-        pass
+        self._cmds.pop(axis, None)
+
+    def __del__(self):
+        # The connection is kept while the controller exists, its
+        # attributes use it even without axes
+        if getattr(self, '_connection', None) is not None:
+            self._release_connection()
 
     @debug_it
     def PrepareOne(self, axis, value, repetitions, latency, nb_starts):
@@ -158,19 +587,12 @@ class Albaem2OneDCtrl(OneDController):
     @debug_it
     def StateAll(self):
         """Read state of all axis."""
-        state = self.sendCmd('ACQU:STAT?')
-
-        if state in ['STATE_ACQUIRING', 'STATE_RUNNING']:
-            self.state = State.Moving
-
-        elif state == 'STATE_ON':
-            self.state = State.On
-
-        elif state == 'STATE_FAULT':
-            self.state = State.Fault
+        self._update_state()
 
-        else:
-            self.state = State.Fault
+    def _update_state(self, use_cache=True):
+        state = self.sendCmd('ACQU:STAT?', use_cache=use_cache)
+        # Unknown answers are considered a fault
+        self.state = STATES.get(state, State.Fault)
         self.status = state
 
     @debug_it
@@ -204,10 +626,12 @@ class Albaem2OneDCtrl(OneDController):
         if error_msg:
             self._log.error(error_msg)
             raise Exception(error_msg)
-        self.sendCmd('ACQU:TIME %r' % val)
+        # The configuration is sent in a single round trip
+        cmds = ['ACQU:TIME %r' % val]
 
-        if self._synchronization in [AcqSynch.SoftwareTrigger,
-                                     AcqSynch.SoftwareGate]:
+        self._sw_synchronization = (
+            self._synchronization in SOFTWARE_SYNCHRONIZATIONS)
+        if self._sw_synchronization:
             self._repetitions = 1
             source = 'SOFTWARE'
 
@@ -221,15 +645,18 @@ class Albaem2OneDCtrl(OneDController):
             self._repetitions = repetitions
             if repetitions == 1:
                 self._repetitions = self._points_per_step
-        self.sendCmd('TRIG:MODE %s' % source)
-        if self._synchronization in [AcqSynch.HardwareTrigger,
-                                     AcqSynch.HardwareGate]:
-            self.sendCmd('TRIG:INPU %s' % self.ExtTriggerInput)
+        cmds.append('TRIG:MODE %s' % source)
+        if self._synchronization in HARDWARE_SYNCHRONIZATIONS:
+            cmds.append('TRIG:INPU %s' % self.ExtTriggerInput)
         # Set Number of Triggers
-        self.sendCmd('ACQU:NTRI %r' % self._repetitions)
+        cmds.append('ACQU:NTRI %r' % self._repetitions)
+        # THIS CONTROLLER IS NOT YET READY FOR TIMESTAMP DATA
+        cmds.append('TMST 0')
+        self.sendCmds(cmds)
 
         # Array of arrays for ID readings from all channels
         self.new_data = [[] for index in range(0, 5)]
+        self._sw_values = ([],) * self.MaxDevice
 
     @debug_it
     @handle_error(msg="PreStartOne: Could not configure the device!")
@@ -249,8 +676,7 @@ class Albaem2OneDCtrl(OneDController):
         PreStartOneCT for master channel.
         """
         cmd = 'ACQU:START'
-        if self._synchronization in [AcqSynch.SoftwareTrigger,
-                                     AcqSynch.SoftwareGate]:
+        if self._sw_synchronization:
             # The HW needs the software trigger
             # APPEND SWTRIG TO THE START COMMAND OR SEND ANOTHER COMMAND
             # TRIG:SWSEt
@@ -262,11 +688,15 @@ class Albaem2OneDCtrl(OneDController):
         # e.g. 10ms ACQTIME -> self.state MAY BE NOT MOVING BECAUSE
         # FINISHED, NOT FAILED
         self.StateAll()
-        t0 = time.time()
+        t0 = monotonic()
+        period = START_POLL_MIN_PERIOD
         while (self.state != State.Moving):
-            if time.time() - t0 > 3:
+            if monotonic() - t0 > START_TIMEOUT:
                 raise Exception('The HW did not start the acquisition')
-            self.StateAll()
+            time.sleep(period)
+            period = min(period * 2, START_POLL_MAX_PERIOD)
+            # Polls are faster than the cache TTL, always ask the HW
+            self._update_state(use_cache=False)
         return True
 
     @debug_it
@@ -277,30 +707,33 @@ class Albaem2OneDCtrl(OneDController):
     @handle_error(msg="ReadAll: Unable to read from the device!")
     def ReadAll(self):
         self.new_data = [[] for index in range(0, 5)]
+        self._sw_values = ([],) * self.MaxDevice
         # Skip reading for aborted scans
         if self._is_aborted:
             return
         data_ready = int(self.sendCmd('ACQU:NDAT?'))
-
-        # THIS CONTROLLER IS NOT YET READY FOR TIMESTAMP DATA
-        self.sendCmd('TMST 0')
-
         msg = 'ACQU:MEAS? %r,%r' % (0, data_ready)
         raw_data = self.sendCmd(msg)
 
-        data = eval(raw_data)
-        axis = 1
-        for chn_name, values in data:
-
-            # Apply the formula for each value
-            formula = self.formulas[axis]
-            formula = formula.lower()
-            values_formula = [eval(formula, {'value': val}) for val
-                                in values]
-            self.new_data[axis].extend(values_formula)
-            axis +=1
-        time_data = [self.itime] * len(self.new_data[1])
-        self.new_data[0] = (time_data)
+        channels = [values for chn_name, values
+                    in parse_measurement(raw_data)]
+        nb_points = set(len(values) for values in channels)
+        if len(nb_points) > 1:
+            raise ValueError(
+                'The channels have different number of points: {0}'.format(
+                    [len(values) for values in channels]))
+        nb_points = nb_points.pop() if nb_points else 0
+        new_data = [np.empty(0, dtype=np.float64)] * self.MaxDevice
+        new_data[0] = np.full(nb_points, self.itime)
+        for axis, values in enumerate(channels, 1):
+            # Apply the formula to all the values of the channel
+            new_data[axis] = self._apply_formula(axis, values)
+        self.new_data = new_data
+        if self._sw_synchronization:
+            # Prepare the ReadOne values of all the axes at once
+            # Axes without data give an empty value
+            self._sw_values = tuple([values[0]] if len(values) else []
+                                    for values in self.new_data)
 
 
     @debug_it
@@ -308,9 +741,8 @@ class Albaem2OneDCtrl(OneDController):
         if len(self.new_data) == 0:
             return None
 
-        if self._synchronization in [AcqSynch.SoftwareTrigger,
-                                     AcqSynch.SoftwareGate]:
-            return [self.new_data[axis - 1][0]]
+        if self._sw_synchronization:
+            return self._sw_values[axis - 1]
         else:
             val = self.new_data[axis - 1]
             return [val]
@@ -321,100 +753,97 @@ class Albaem2OneDCtrl(OneDController):
         self.sendCmd('ACQU:STOP')
         self._is_aborted = True
 
+    @staticmethod
+    def _compile_formula(formula):
+        # Build the formula as a function once, so ReadAll can apply it to
+        # the whole channel buffer as a NumPy array
+        formula = formula.lower()
+        if formula.strip() == 'value':
+            # Identity, the values are used as they are read
+            return None
+        code = compile('lambda value: ' + formula, '<formula>', 'eval')
+        return eval(code, {})
+
+    def _apply_formula(self, axis, values):
+        func = self._formula_funcs[axis]
+        if func is None:
+            return values
+        try:
+            result = np.asarray(func(values), dtype=np.float64)
+            if result.shape == values.shape:
+                return result
+            if result.ndim == 0:
+                # Constant formulas, e.g. "0", give one value for all points
+                return np.full(values.shape, result)
+            raise ValueError('Formula result does not match the values')
+        except Exception:
+            # Formulas which are not array friendly, e.g. "int(value)",
+            # are evaluated value by value
+            return np.array([func(val) for val in values], dtype=np.float64)
+
+    def _acquire_connection(self):
+        # Only the bookkeeping is done under the lock, a controller may be
+        # garbage collected in the thread which is being waited for
+        with self._connections_lock:
+            connection = self._connections.get(self.ip_config)
+            is_new = connection is None
+            if is_new:
+                connection = AlbaemConnection(*self.ip_config)
+                self._connections[self.ip_config] = connection
+                self._connection_users[self.ip_config] = 0
+            self._connection_users[self.ip_config] += 1
+        self._connection = connection
+        try:
+            if is_new:
+                connection.connect()
+            else:
+                connection.ensure_alive()
+        except Exception:
+            self._release_connection()
+            raise
+
+    def _release_connection(self):
+        connection, self._connection = self._connection, None
+        if connection is None:
+            return
+        with self._connections_lock:
+            self._connection_users[self.ip_config] -= 1
+            is_unused = self._connection_users[self.ip_config] == 0
+            if is_unused:
+                del self._connections[self.ip_config]
+                del self._connection_users[self.ip_config]
+        if is_unused:
+            # Last controller using it, do not keep the socket open
+            connection.close()
+
     @debug_it
     @handle_error(msg="sendCmd: Could not configure device!")
-    def sendCmd(self, cmd, rw=True, size=8096):
-        with self.lock:
-            cmd += ';\n'
-
-            # Protection in case of reconnect the device in the network.
-            # It send the command and in case of broken socket it creates a
-            # new one.
-            retries = 2
-            for i in range(retries):
-                try:
-                    self.albaem_socket.sendall(cmd.encode())
-                    break
-                except socket.timeout:
-                    self._log.debug(
-                        'Socket timeout! reconnecting and commanding '
-                        'again %s' % cmd)
-                    self.albaem_socket = socket.socket(
-                        socket.AF_INET, socket.SOCK_STREAM)
-                    self.albaem_socket.settimeout(1)
-                    self.albaem_socket.connect(self.ip_config)
-            if rw:
-                # WARNING...
-                # socket.recv(size) IS NEVER ENOUGH TO RECEIVE DATA !!!
-                # you should know by the protocol either:
-                # the length of data to be received
-                # or
-                # wait until a special end-of-transfer control
-                # In this case: while not '\r' in data:
-                #                 receive more data...
-                ################################################
-                # AS IT IS SAID IN https://docs.python.org/3/howto/sockets.html
-                # SECTION "3 Using a Socket"
-                #
-                # A protocol like HTTP uses a socket for only one
-                # transfer. The client sends a request, the reads a
-                # reply. That's it. The socket is discarded. This
-                # means that a client can detect the end of the reply
-                # by receiving 0 bytes.
-                #
-                # But if you plan to reuse your socket for further
-                # transfers, you need to realize that there is no
-                # "EOT" (End of Transfer) on a socket. I repeat: if a
-                # socket send or recv returns after handling 0 bytes,
-                # the connection has been broken. If the connection
-                # has not been broken, you may wait on a recv forever,
-                # because the socket will not tell you that there's
-                # nothing more to read (for now). Now if you think
-                # about that a bit, you'll come to realize a
-                # fundamental truth of sockets: messages must either
-                # be fixed length (yuck), or be delimited (shrug), or
-                # indicate how long they are (much better), or end by
-                # shutting down the connection. The choice is entirely
-                # yours, (but some ways are righter than others).
-                ################################################
-                data = ""
-                acquired = False
-                while True:
-                    # SOME TIMEOUTS OCCUR WHEN USING THE WEBPAGE
-                    retries = 5
-                    for i in range(retries):
-                        try:
-                            data += self.albaem_socket.recv(size).decode()
-                            acquired = True
-                            break
-                        except socket.timeout:
-                            self._log.debug(
-                                'Socket timeout! Reading... from  %s '
-                                'command' %cmd[:-2])
-                            self.albaem_socket = socket.socket(
-                                socket.AF_INET, socket.SOCK_STREAM)
-                            self.albaem_socket.settimeout(1)
-                            self.albaem_socket.connect(self.ip_config)
-                            self.albaem_socket.sendall(cmd.encode())
-                            pass
-
-                    if acquired == False:
-                        msg = "Unable to communicate with AlbaEm2, try to " \
-                              "restart the Device"
-                        raise RuntimeError(msg)
-                    try:
-                        if data[-1] == '\n':
-                            break
-                    except Exception as e:
-                        self._log.error(e)
-                        return None
-
-                # NOTE: EM MAY ANSWER WITH MULTIPLE ANSWERS IN CASE OF AN
-                # EXCEPTION
-                # SIMPLY GET THE LAST ONE
-                if data.count(';') > 1:
-                    data = data.rsplit(';')[-2:]
-                return data[:-2]
+    def sendCmd(self, cmd, rw=True, use_cache=True):
+        data = self._connection.command(cmd, rw, use_cache=use_cache)
+        if data is None:
+            return None
+        # NOTE: EM MAY ANSWER WITH MULTIPLE ANSWERS IN CASE OF AN
+        # EXCEPTION
+        # SIMPLY GET THE LAST ONE
+        if data.count(';') > 1:
+            data = data.rsplit(';')[-2:]
+        return data[:-2]
+
+    @debug_it
+    @handle_error(msg="sendCmds: Could not configure device!")
+    def sendCmds(self, cmds):
+        """Send several commands without waiting for the answer of each one
+        before sending the next, saving a round trip per command. Return
+        the list of answers."""
+        answers = []
+        for cmd, data in zip(cmds, self._connection.commands(cmds)):
+            # In case of an exception the EM may give several answers,
+            # the last one is kept as in sendCmd
+            answer = data[:-2].rsplit(';', 1)[-1]
+            if answer.startswith('ERROR'):
+                raise RuntimeError('{0} failed: {1}'.format(cmd, answer))
+            answers.append(answer)
+        return answers
 
 ###############################################################################
 #                Axis Extra Attribute Methods
@@ -425,27 +854,21 @@ class Albaem2OneDCtrl(OneDController):
     def get_Range(self, axis):
         if axis == 1:
             raise RuntimeError('The axis 1 does not use the extra attributes')
-        axis -= 1
-        cmd = 'CHAN{0:02d}:CABO:RANGE?'.format(axis)
-        return self.sendCmd(cmd)
+        return self.sendCmd(self._cmds[axis]['range_q'])
 
     @debug_it
     @handle_error(msg="set_Range:")
     def set_Range(self, axis, value):
         if axis == 1:
             raise RuntimeError('The axis 1 does not use the extra attributes')
-        axis -= 1
-        cmd = 'CHAN{0:02d}:CABO:RANGE {1}'.format(axis, value)
-        self.sendCmd(cmd)
+        self.sendCmd(self._cmds[axis]['range_s'] + str(value))
 
     @debug_it
     @handle_error(msg="get_Inversion:")
     def get_Inversion(self, axis):
         if axis == 1:
             raise RuntimeError('The axis 1 does not use the extra attributes')
-        axis -= 1
-        cmd = 'CHAN{0:02d}:CABO:INVE?'.format(axis)
-        val = self.sendCmd(cmd)
+        val = self.sendCmd(self._cmds[axis]['inv_q'])
         if val.lower() == 'off':
             ret = False
         elif val.lower() == 'on':
@@ -457,18 +880,29 @@ class Albaem2OneDCtrl(OneDController):
     def set_Inversion(self, axis, value):
         if axis == 1:
             raise RuntimeError('The axis 1 does not use the extra attributes')
-        axis -= 1
-        cmd = 'CHAN{0:02d}:CABO:INVE {1}'.format(axis, int(value))
-        self.sendCmd(cmd)
+        self.sendCmd(self._cmds[axis]['inv_s'] + str(int(value)))
 
     @debug_it
     @handle_error(msg="get_InstantCurrent:")
     def get_InstantCurrent(self, axis):
         if axis == 1:
             raise RuntimeError('The axis 1 does not use the extra attributes')
-        axis -= 1
-        cmd = 'CHAN{0:02d}:INSCurrent?'.format(axis)
-        return eval(self.sendCmd(cmd))
+        return eval(self.sendCmd(self._cmds[axis]['cur_q']))
+
+    @debug_it
+    @handle_error(msg="get_Formula:")
+    def get_Formula(self, axis):
+        if axis == 1:
+            raise RuntimeError('The axis 1 does not use the extra attributes')
+        return self.formulas[axis - 1]
+
+    @debug_it
+    @handle_error(msg="set_Formula:")
+    def set_Formula(self, axis, value):
+        if axis == 1:
+            raise RuntimeError('The axis 1 does not use the extra attributes')
+        self._formula_funcs[axis - 1] = self._compile_formula(value)
+        self.formulas[axis - 1] = value
 
 
 ###############################################################################
@@ -495,3 +929,9 @@ class Albaem2OneDCtrl(OneDController):
     @handle_error(msg="set_PointsPerStep:")
     def set_PointsPerStep(self, value):
         self._points_per_step = value
+
+
+@atexit.register
+def _close_connections():
+    for connection in Albaem2OneDCtrl._connections.values():
+        connection.close()
@@ -0,0 +1,628 @@
+#!/usr/bin/env python
+
+"""Tests for the Albaem2OneDCtrl controller helpers."""
+
+import logging
+import socket
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from sardana import State
+from sardana.pool import AcqSynch
+from sardana.pool.controller import OneDController
+
+from sardana_albaem.ctrl import Albaem2OneDCtrl as ctrl_module
+from sardana_albaem.ctrl.Albaem2OneDCtrl import Albaem2OneDCtrl, \
+    AlbaemConnection, parse_measurement
+
+__author__ = 'kits'
+__docformat__ = 'restructuredtext'
+
+
+def apply_formula(formula, values):
+    ctrl = Albaem2OneDCtrl.__new__(Albaem2OneDCtrl)
+    ctrl._formula_funcs = {1: Albaem2OneDCtrl._compile_formula(formula)}
+    return ctrl._apply_formula(1, np.asarray(values, dtype=np.float64))
+
+
+@pytest.mark.parametrize('formula, expected', [
+    ('value', [-1.5, 2.0, 4.0]),
+    ('(VALUE/10)*1e-06', [-1.5e-7, 2e-7, 4e-7]),
+    ('max(value, 0)', [0.0, 2.0, 4.0]),
+    ('int(value)', [-1.0, 2.0, 4.0]),
+    ('2', [2.0, 2.0, 2.0]),
+])
+def test_apply_formula(formula, expected):
+    result = apply_formula(formula, [-1.5, 2.0, 4.0])
+    assert result.dtype == np.float64
+    np.testing.assert_allclose(result, expected)
+
+
+def test_apply_formula_returns_writable_array():
+    result = apply_formula('2', [1.0, 2.0])
+    assert result.flags.writeable
+    result[0] = 0
+    np.testing.assert_allclose(result, [0.0, 2.0])
+
+
+def test_parse_measurement():
+    data = parse_measurement(
+        "[['CHAN01', [1.0, 2e-09]], ['CHAN02', [-3, 4.5]]];")
+    assert [chn_name for chn_name, values in data] == ['CHAN01', 'CHAN02']
+    np.testing.assert_allclose(data[0][1], [1.0, 2e-09])
+    np.testing.assert_allclose(data[1][1], [-3.0, 4.5])
+
+
+def test_parse_measurement_empty_channels():
+    data = parse_measurement("[['CHAN01', []], ['CHAN02', []]]")
+    assert [chn_name for chn_name, values in data] == ['CHAN01', 'CHAN02']
+    assert all(values.dtype == np.float64 and values.size == 0
+               for chn_name, values in data)
+
+
+def test_parse_measurement_literal_eval_fallback():
+    data = parse_measurement("[('CHAN01', (1.0, 2.0))]")
+    assert data[0][0] == 'CHAN01'
+    np.testing.assert_allclose(data[0][1], [1.0, 2.0])
+    assert parse_measurement('[]') == []
+
+
+def test_parse_measurement_malformed_value():
+    with pytest.raises(ValueError):
+        parse_measurement("[['CHAN01', [1.0, 2.0, x]]]")
+
+
+class FakeAlbaem(object):
+    """Loopback SCPI server, the handler gives the bytes to send back for
+    each received line (commands included, terminator excluded)."""
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.connections = 0
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.bind(('127.0.0.1', 0))
+        self._server.listen(5)
+        self.address = self._server.getsockname()
+        thread = threading.Thread(target=self._serve)
+        thread.daemon = True
+        thread.start()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self._server.accept()
+            except socket.error:
+                return
+            self.connections += 1
+            thread = threading.Thread(target=self._handle, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def _handle(self, conn):
+        try:
+            for line in conn.makefile('rb'):
+                answer = self.handler(line.decode().rstrip('\n'), conn)
+                if answer:
+                    conn.sendall(answer)
+        finally:
+            conn.close()
+
+    def close(self):
+        self._server.close()
+
+
+@pytest.fixture
+def fake_albaem():
+    servers = []
+
+    def create(handler):
+        server = FakeAlbaem(handler)
+        servers.append(server)
+        return server
+
+    yield create
+    for server in servers:
+        server.close()
+
+
+@pytest.fixture
+def connect():
+    connections = []
+
+    def create(server):
+        connection = AlbaemConnection(*server.address)
+        connection.connect()
+        connections.append(connection)
+        return connection
+
+    yield create
+    for connection in connections:
+        connection.close()
+
+
+def wait_connections(server, nb_connections, timeout=1.0):
+    # The server counts the connections from its own thread
+    deadline = time.time() + timeout
+    while server.connections < nb_connections and time.time() < deadline:
+        time.sleep(0.01)
+    return server.connections
+
+
+@pytest.fixture
+def create_ctrl(monkeypatch):
+    def init(self, inst, props, *args, **kwargs):
+        # What the Sardana controller classes set and this controller uses
+        self._log = logging.getLogger(inst)
+        for name, value in props.items():
+            setattr(self, name, value)
+        self._latency_time = 0
+        self._synchronization = AcqSynch.SoftwareTrigger
+
+    monkeypatch.setattr(OneDController, '__init__', init)
+
+    def create(address):
+        host, port = address
+        props = {'AlbaEmHost': host, 'Port': port,
+                 'ExtTriggerInput': 'TRIGGER_IN'}
+        return Albaem2OneDCtrl('albaem', props)
+
+    # No reference is kept, the controllers release their connection when
+    # the tests drop them
+    return create
+
+
+def answer_command(line, conn):
+    return 'ANS({0});\n'.format(line.rstrip(';')).encode()
+
+
+def test_send_cmds(fake_albaem, create_ctrl):
+    lines = []
+
+    def handler(line, conn):
+        # No answer until all the commands were received
+        lines.append(line)
+        if len(lines) < 2:
+            return None
+        answers = [b'ERROR: wrong value;\n' if 'ACQU:NTRI 0' in line
+                   else answer_command(line, conn) for line in lines]
+        del lines[:]
+        return b''.join(answers)
+
+    ctrl = create_ctrl(fake_albaem(handler).address)
+    assert ctrl.sendCmds(['ACQU:TIME 1', 'TMST 0']) == \
+        ['ANS(ACQU:TIME 1)', 'ANS(TMST 0)']
+    with pytest.raises(RuntimeError) as exc_info:
+        ctrl.sendCmds(['ACQU:TIME 1', 'ACQU:NTRI 0'])
+    assert 'wrong value' in str(exc_info.value.__cause__)
+
+
+def measurement_server(fake_albaem, meas):
+    def handler(line, conn):
+        if line.startswith('ACQU:NDAT?'):
+            return b'2;\n'
+        return meas.encode() + b';\n'
+    return fake_albaem(handler)
+
+
+def create_reading_ctrl(create_ctrl, address,
+                        synchronization=AcqSynch.HardwareTrigger):
+    ctrl = create_ctrl(address)
+    ctrl._synchronization = synchronization
+    ctrl.LoadOne(1, 0.1, 2, 0)
+    return ctrl
+
+
+def test_read_all(fake_albaem, create_ctrl):
+    server = measurement_server(
+        fake_albaem, "[['CHAN01', [1.0, 2.0]], ['CHAN02', [3.0, 4.0]], "
+                     "['CHAN03', [5.0, 6.0]], ['CHAN04', [7.0, 8.0]]]")
+    ctrl = create_reading_ctrl(create_ctrl, server.address)
+    ctrl.ReadAll()
+    np.testing.assert_allclose(ctrl.ReadOne(1)[0], [0.1, 0.1])
+    np.testing.assert_allclose(ctrl.ReadOne(5)[0], [7.0, 8.0])
+
+
+def test_read_all_no_channels(fake_albaem, create_ctrl):
+    ctrl = create_reading_ctrl(
+        create_ctrl, measurement_server(fake_albaem, '[]').address)
+    ctrl.ReadAll()
+    assert all(len(ctrl.ReadOne(axis)[0]) == 0 for axis in range(1, 6))
+
+
+def test_read_all_software_synchronization(fake_albaem, create_ctrl):
+    server = measurement_server(
+        fake_albaem, "[['CHAN01', [1.0, 2.0]], ['CHAN02', [3.0, 4.0]]]")
+    ctrl = create_reading_ctrl(create_ctrl, server.address,
+                               AcqSynch.SoftwareTrigger)
+    ctrl.ReadAll()
+    assert ctrl.ReadOne(1) == [0.1]
+    assert ctrl.ReadOne(3) == [3.0]
+    # The channels which were not read give an empty value
+    assert ctrl.ReadOne(5) == []
+
+
+def test_read_all_different_lengths(fake_albaem, create_ctrl):
+    server = measurement_server(
+        fake_albaem, "[['CHAN01', [1.0, 2.0]], ['CHAN02', [3.0]]]")
+    ctrl = create_reading_ctrl(create_ctrl, server.address)
+    with pytest.raises(RuntimeError) as exc_info:
+        ctrl.ReadAll()
+    assert 'different number of points' in str(exc_info.value.__cause__)
+
+
+def test_connection_pool(fake_albaem, create_ctrl):
+    server = fake_albaem(answer_command)
+    ctrl1 = create_ctrl(server.address)
+    ctrl2 = create_ctrl(server.address)
+    connection = ctrl1._connection
+    assert ctrl2._connection is connection
+    assert wait_connections(server, 1) == 1
+    ctrl1.AddDevice(2)
+    ctrl1.DeleteDevice(2)
+    # The controller attributes still work without axes
+    assert ctrl1.get_AcquisitionMode() == 'ANS(ACQU:MODE?)'
+    del ctrl1
+    assert Albaem2OneDCtrl._connections[server.address] is connection
+    del ctrl2
+    assert server.address not in Albaem2OneDCtrl._connections
+    assert connection._sock is None
+
+
+def command_in_threads(connection, cmds):
+    answers = {}
+
+    def command(cmd):
+        answers[cmd] = connection.command(cmd)
+
+    threads = [threading.Thread(target=command, args=(cmd,)) for cmd in cmds]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return answers
+
+
+def test_connection_answers_in_one_chunk(fake_albaem, connect):
+    lines = []
+
+    def handler(line, conn):
+        # Hold the answers until all the commands are in flight
+        lines.append(line.rstrip(';'))
+        if len(lines) == 3:
+            return b''.join('ANS({0});\n'.format(cmd).encode()
+                            for cmd in lines)
+
+    connection = connect(fake_albaem(handler))
+    cmds = ['ACQU:STAT?', 'ACQU:NDAT?', 'ACQU:MODE?']
+    answers = command_in_threads(connection, cmds)
+    assert answers == {cmd: 'ANS({0});\n'.format(cmd) for cmd in cmds}
+
+
+def test_connection_answer_in_several_chunks(fake_albaem, connect):
+    answers = {'ACQU:MEAS?': "[['CHAN01', [1.0, 2.0]]];\n",
+               'ACQU:STAR': 'ACK;\n'}
+    lines = []
+
+    def handler(line, conn):
+        lines.append(line.rstrip(';'))
+        if len(lines) < 2:
+            return
+        # Chunks ending in the middle of the answers
+        data = ''.join(answers[cmd] for cmd in lines).encode()
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        for start, end in ((0, 10), (10, len(data) - 3), (-3, None)):
+            conn.sendall(data[start:end])
+            time.sleep(0.05)
+
+    connection = connect(fake_albaem(handler))
+    assert command_in_threads(connection, list(answers)) == answers
+
+
+def test_connection_resend_after_drop(fake_albaem, connect):
+    def handler(line, conn):
+        if server.connections == 1:
+            # Drop the connection in the middle of the command
+            conn.shutdown(socket.SHUT_RDWR)
+            return None
+        return 'ANS({0});\n'.format(line.rstrip(';')).encode()
+
+    server = fake_albaem(handler)
+    connection = connect(server)
+    assert connection.command('ACQU:STAT?') == 'ANS(ACQU:STAT?);\n'
+    assert server.connections == 2
+
+
+def test_connection_lost_answer(fake_albaem, connect):
+    def handler(line, conn):
+        cmd = line.rstrip(';')
+        if cmd != 'ACQU:STAT?':
+            return 'ANS({0});\n'.format(cmd).encode()
+
+    server = fake_albaem(handler)
+    connection = connect(server)
+    with pytest.raises(RuntimeError):
+        connection.command('ACQU:STAT?', timeout=0.1)
+    # The late answer can not be taken for the one of the next command
+    assert wait_connections(server, 2) == 2
+    assert connection.command('ACQU:NDAT?') == 'ANS(ACQU:NDAT?);\n'
+
+
+def test_connection_reading_handed_over(fake_albaem, connect):
+    received = threading.Event()
+
+    def handler(line, conn):
+        received.set()
+        # The first thread reads the socket while the second one waits
+        time.sleep(0.1)
+        return 'ANS({0});\n'.format(line.rstrip(';')).encode()
+
+    connection = connect(fake_albaem(handler))
+    answers = {}
+
+    def command(cmd):
+        answers[cmd] = connection.command(cmd, timeout=2)
+
+    first = threading.Thread(target=command, args=('ACQU:STAT?',))
+    first.start()
+    received.wait(1)
+    t0 = time.time()
+    command('ACQU:NDAT?')
+    first.join()
+    # Without the handover the second answer waits for the timeout
+    assert time.time() - t0 < 1
+    assert answers == {'ACQU:STAT?': 'ANS(ACQU:STAT?);\n',
+                       'ACQU:NDAT?': 'ANS(ACQU:NDAT?);\n'}
+
+
+def test_connection_answer_dropped(fake_albaem, connect):
+    connection = connect(fake_albaem(answer_command))
+    assert connection.command('ACQU:STOP', rw=False) is None
+    # The answer of the first command is not taken by the second one
+    assert connection.command('ACQU:STAT?') == 'ANS(ACQU:STAT?);\n'
+
+
+def test_connection_pool_during_read(fake_albaem, create_ctrl):
+    received = []
+
+    def handler(line, conn):
+        received.append(line)
+        if line.startswith('ACQU:MEAS?'):
+            time.sleep(0.5)
+        return 'ANS({0});\n'.format(line.rstrip(';')).encode()
+
+    server = fake_albaem(handler)
+    ctrl1 = create_ctrl(server.address)
+    thread = threading.Thread(target=ctrl1.sendCmd, args=('ACQU:MEAS? 0,2',))
+    thread.start()
+    time.sleep(0.1)
+    # A new controller does not interrupt the long answer
+    create_ctrl(server.address)
+    thread.join()
+    assert server.connections == 1
+    assert received == ['ACQU:MEAS? 0,2;']
+
+
+def test_connection_resend_after_drop_in_commands(fake_albaem, connect):
+    received = []
+
+    def handler(line, conn):
+        received.append(line)
+        if server.connections == 1 and len(received) == 2:
+            conn.shutdown(socket.SHUT_RDWR)
+            return None
+        return answer_command(line, conn)
+
+    server = fake_albaem(handler)
+    connection = connect(server)
+    assert connection.commands(['ACQU:TIME 1', 'TMST 0']) == \
+        ['ANS(ACQU:TIME 1);\n', 'ANS(TMST 0);\n']
+    # Only the command without answer is sent again
+    assert received == ['ACQU:TIME 1;', 'TMST 0;', 'TMST 0;']
+
+
+def counting_server(fake_albaem, delays=None):
+    # Answer every command, after the delay of its name if given
+    received = []
+
+    def handler(line, conn):
+        cmd = line.rstrip(';')
+        received.append(cmd)
+        time.sleep((delays or {}).get(cmd, 0))
+        return answer_command(line, conn)
+
+    return fake_albaem(handler), received
+
+
+def test_cache_hit(fake_albaem, connect, monkeypatch):
+    monkeypatch.setattr(ctrl_module, 'CMD_CACHE_TTL', 10)
+    server, received = counting_server(fake_albaem)
+    connection = connect(server)
+    for i in range(2):
+        assert connection.command('ACQU:STAT?') == 'ANS(ACQU:STAT?);\n'
+    # Only the queries which do not change anything are cached
+    for i in range(2):
+        connection.command('ACQU:MEAS?')
+    assert received == ['ACQU:STAT?', 'ACQU:MEAS?', 'ACQU:MEAS?']
+
+
+def test_cache_expiry(fake_albaem, connect, monkeypatch):
+    monkeypatch.setattr(ctrl_module, 'CMD_CACHE_TTL', 0.05)
+    server, received = counting_server(fake_albaem)
+    connection = connect(server)
+    connection.command('ACQU:STAT?')
+    time.sleep(0.1)
+    connection.command('ACQU:STAT?')
+    assert received == ['ACQU:STAT?', 'ACQU:STAT?']
+
+
+def test_cache_bypass(fake_albaem, connect, monkeypatch):
+    monkeypatch.setattr(ctrl_module, 'CMD_CACHE_TTL', 10)
+    server, received = counting_server(fake_albaem)
+    connection = connect(server)
+    connection.command('ACQU:STAT?')
+    connection.command('ACQU:STAT?', use_cache=False)
+    assert received == ['ACQU:STAT?', 'ACQU:STAT?']
+
+
+def test_cache_invalidation(fake_albaem, connect, monkeypatch):
+    monkeypatch.setattr(ctrl_module, 'CMD_CACHE_TTL', 10)
+    server, received = counting_server(fake_albaem)
+    connection = connect(server)
+    connection.command('ACQU:STAT?')
+    connection.commands(['ACQU:TIME 1', 'TMST 0'])
+    connection.command('ACQU:STAT?')
+    connection.command('ACQU:START')
+    connection.command('ACQU:STAT?')
+    assert received == ['ACQU:STAT?', 'ACQU:TIME 1', 'TMST 0', 'ACQU:STAT?',
+                        'ACQU:START', 'ACQU:STAT?']
+
+
+def test_cache_answer_crossing_start(fake_albaem, connect, monkeypatch):
+    monkeypatch.setattr(ctrl_module, 'CMD_CACHE_TTL', 10)
+    server, received = counting_server(fake_albaem, {'ACQU:STAT?': 0.2})
+    connection = connect(server)
+    thread = threading.Thread(target=connection.command,
+                              args=('ACQU:STAT?',))
+    thread.start()
+    time.sleep(0.1)
+    # The state asked before the start is not kept for after it
+    connection.command('ACQU:START')
+    thread.join()
+    connection.command('ACQU:STAT?')
+    assert received == ['ACQU:STAT?', 'ACQU:START', 'ACQU:STAT?']
+
+
+class SleepRecorder(object):
+    """Stand-in for the time module of the controller."""
+
+    def __init__(self):
+        self.periods = []
+
+    def sleep(self, period):
+        self.periods.append(period)
+
+
+def state_server(fake_albaem, states):
+    # Answer ACQU:STAT? with the given states, the last one is kept
+    states = list(states)
+    received = []
+
+    def handler(line, conn):
+        cmd = line.rstrip(';')
+        received.append(cmd)
+        if cmd == 'ACQU:STAT?':
+            state = states.pop(0) if len(states) > 1 else states[0]
+            return '{0};\n'.format(state).encode()
+        return b'ACK;\n'
+
+    return fake_albaem(handler), received
+
+
+def test_start_all_backoff(fake_albaem, create_ctrl, monkeypatch):
+    sleep = SleepRecorder()
+    monkeypatch.setattr(ctrl_module, 'time', sleep)
+    monkeypatch.setattr(ctrl_module, 'CMD_CACHE_TTL', 10)
+    server, received = state_server(
+        fake_albaem, ['STATE_ON'] * 10 + ['STATE_ACQUIRING'])
+    ctrl = create_ctrl(server.address)
+    assert ctrl.StartAll() is True
+    # Every poll asks the HW, the cached state is not used
+    assert received.count('ACQU:STAT?') == 11
+    assert sleep.periods == [0.0002, 0.0004, 0.0008, 0.0016, 0.0032, 0.0064,
+                             0.01, 0.01, 0.01, 0.01]
+    assert ctrl.StateOne(1) == (State.Moving, 'STATE_ACQUIRING')
+
+
+def test_start_all_timeout(fake_albaem, create_ctrl, monkeypatch):
+    monkeypatch.setattr(ctrl_module, 'START_TIMEOUT', 0.1)
+    server, received = state_server(fake_albaem, ['STATE_ON'])
+    ctrl = create_ctrl(server.address)
+    with pytest.raises(RuntimeError) as exc_info:
+        ctrl.StartAll()
+    assert 'did not start' in str(exc_info.value.__cause__)
+
+
+@pytest.mark.parametrize('answer, state', [
+    ('STATE_ACQUIRING', State.Moving),
+    ('STATE_RUNNING', State.Moving),
+    ('STATE_ON', State.On),
+    ('STATE_FAULT', State.Fault),
+    # Unknown answers are considered a fault
+    ('STATE_OFF', State.Fault),
+    ('', State.Fault),
+])
+def test_state_all(fake_albaem, create_ctrl, answer, state):
+    server, received = state_server(fake_albaem, [answer])
+    ctrl = create_ctrl(server.address)
+    ctrl.StateAll()
+    for axis in range(1, 6):
+        assert ctrl.StateOne(axis) == (state, answer)
+
+
+def channel_server(fake_albaem):
+    received = []
+    answers = {'CABO:RANGE?': '1mA', 'CABO:INVE?': 'ON',
+               'INSCurrent?': '1e-09'}
+
+    def handler(line, conn):
+        cmd = line.rstrip(';')
+        received.append(cmd)
+        answer = answers.get(cmd.split(':', 1)[-1], 'ACK')
+        return '{0};\n'.format(answer).encode()
+
+    return fake_albaem(handler), received
+
+
+def test_channel_commands(fake_albaem, create_ctrl):
+    server, received = channel_server(fake_albaem)
+    ctrl = create_ctrl(server.address)
+    for axis in range(1, 6):
+        ctrl.AddDevice(axis)
+    assert ctrl.get_Range(3) == '1mA'
+    ctrl.set_Range(3, '100uA')
+    assert ctrl.get_Inversion(5) is True
+    ctrl.set_Inversion(5, False)
+    assert ctrl.get_InstantCurrent(2) == 1e-09
+    # The axis 2 is the channel 1
+    assert received == ['CHAN02:CABO:RANGE?', 'CHAN02:CABO:RANGE 100uA',
+                        'CHAN04:CABO:INVE?', 'CHAN04:CABO:INVE 0',
+                        'CHAN01:INSCurrent?']
+
+
+def test_channel_commands_deleted_axis(fake_albaem, create_ctrl):
+    server, received = channel_server(fake_albaem)
+    ctrl = create_ctrl(server.address)
+    ctrl.AddDevice(1)
+    ctrl.AddDevice(2)
+    ctrl.DeleteDevice(2)
+    # The axis 1 is the timer, it has no channel commands
+    for axis in (1, 2):
+        with pytest.raises(RuntimeError):
+            ctrl.get_Range(axis)
+    assert received == []
+
+
+@pytest.mark.parametrize('synchronization, cmds, start', [
+    (AcqSynch.SoftwareTrigger,
+     ['TRIG:MODE SOFTWARE', 'ACQU:NTRI 1'], 'ACQU:START SWTRIG'),
+    (AcqSynch.SoftwareGate,
+     ['TRIG:MODE SOFTWARE', 'ACQU:NTRI 1'], 'ACQU:START SWTRIG'),
+    (AcqSynch.HardwareTrigger,
+     ['TRIG:MODE HARDWARE', 'TRIG:INPU TRIGGER_IN', 'ACQU:NTRI 3'],
+     'ACQU:START'),
+    (AcqSynch.HardwareGate,
+     ['TRIG:MODE GATE', 'TRIG:INPU TRIGGER_IN', 'ACQU:NTRI 3'],
+     'ACQU:START'),
+])
+def test_synchronization(fake_albaem, create_ctrl, synchronization, cmds,
+                         start):
+    server, received = state_server(fake_albaem, ['STATE_ACQUIRING'])
+    ctrl = create_ctrl(server.address)
+    ctrl._synchronization = synchronization
+    ctrl.LoadOne(1, 0.1, 3, 0)
+    ctrl.StartAll()
+    assert received == ['ACQU:TIME 100.0'] + cmds + ['TMST 0', start,
+                                                     'ACQU:STAT?']
@@ -41,6 +41,7 @@ def main():
     # Add your dependencies in the following line.
     install_requires = [
         "sardana",
+        "numpy",
         "sockio",
         "pyzmq<20.0; python_version<'3'",
         "pyzmq; python_version>='3'",